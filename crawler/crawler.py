@@ -1,17 +1,76 @@
 import os
+import re
 import sys
-import json
+import io
 import gzip
+import shutil
 import calendar
+import functools
 import gridfs
 import traceback
+from dataclasses import dataclass, field
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import freeze_support
 from json.decoder import JSONDecodeError
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+try:
+    import urllib3
+except ImportError:
+    urllib3 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+from bson import ObjectId, encode
+from bson.errors import InvalidDocument
+from bson.raw_bson import RawBSONDocument
 from pymongo import MongoClient
-from pymongo.errors import DocumentTooLarge, WriteError
+from pymongo.errors import BulkWriteError, DocumentTooLarge, DuplicateKeyError, OperationFailure, WriteError
 from urllib.request import Request, urlopen
 from urllib.error import HTTPError, URLError
 
 
+# number of events sent to mongodb in a single `insert_many` call.
+INSERT_BATCH_SIZE = 1000
+# size of the buffer used when reading decompressed gh archive data.
+READ_BUFFER_SIZE = 1 << 20
+# size of the buffer used when copying downloads into the local filesystem.
+DOWNLOAD_BUFFER_SIZE = 4 << 20
+# number of hourly gh archive files downloaded concurrently.
+DOWNLOAD_CONCURRENCY = 8
+# write error codes of events that are stored in gridfs instead: BadValue,
+# DollarPrefixedFieldName, DottedFieldName and BSONObjectTooLarge.
+GRIDFS_FALLBACK_ERROR_CODES = {2, 52, 57, 10334}
+# maximum number of worker processes ingesting days in parallel. Each of them
+# downloads up to `DOWNLOAD_CONCURRENCY` hours at a time, so this also bounds the
+# number of concurrent requests to the gh archive server.
+MAX_WORKER_PROCESSES = 4
+# number of days ingested by a worker process before it is replaced, which
+# bounds the memory held by long-running workers.
+DAYS_PER_WORKER = 4
+# connection options tuned for bulk ingestion, which can be overridden by the
+# `params` of the mongodb token.
+MONGODB_DEFAULT_PARAMS = {
+    'maxPoolSize': 32,
+    'minPoolSize': 8,
+    'retryWrites': 'true',
+    'w': 1,
+}
+# pymongo warns on every client creation if zstd is requested but unavailable.
+if zstandard is not None:
+    MONGODB_DEFAULT_PARAMS['compressors'] = 'zstd'
+
+
+@functools.lru_cache(maxsize=None)
+def _load_token_file(path) -> dict:
+    # token files are parsed once per process, callers must not modify the result.
+    with open(path, 'rb') as f:
+        return _json.loads(f.read())
+
+
 def load_token(path, **kwargs) -> dict:
     """
     Load token from both `path` and `kwargs`. Please save public information in
@@ -22,197 +81,521 @@ def load_token(path, **kwargs) -> dict:
     :param kwargs: private information that provided through (command) arguments.
     :return: tokens in dictionary format.
     """
-    token = dict()
+    custom_token: dict = _load_token_file(path) if os.path.exists(path) else {}
+    return {**custom_token, **kwargs}
+
+
+@dataclass(slots=True, frozen=True)
+class MongoToken:
+    """
+    Token to connect to the mongodb that stores gh archive data.
+    """
+    user: str
+    password: str = field(repr=False)
+    ip: str
+    port: int
+    db: str
+    params: dict
+
+
+@dataclass(slots=True, frozen=True)
+class GhArchiveToken:
+    """
+    Token to request gh archive data from the server.
+    """
+    url: str
+    headers: dict
+
+
+def load_mongodb_token(path, **kwargs) -> MongoToken:
+    """
+    Load mongodb token from both `path` and `kwargs`, see `load_token`.
+    :param path: file path that usually saves public information.
+    :param kwargs: private information that provided through (command) arguments.
+    :return: mongodb token.
+    """
+    return MongoToken(**load_token(path, **kwargs))
+
+
+def load_gh_archive_token(path, **kwargs) -> GhArchiveToken:
+    """
+    Load gh archive token from both `path` and `kwargs`, see `load_token`.
+    :param path: file path that usually saves public information.
+    :param kwargs: private information that provided through (command) arguments.
+    :return: gh archive token.
+    """
+    return GhArchiveToken(**load_token(path, **kwargs))
+
+
+def iter_lines(stream, chunk_size=READ_BUFFER_SIZE):
+    """
+    Split `stream` into lines by reading it in large chunks. Compared with calling
+    `readline` once per line, this lets `bytes.split` do the scanning in C. Lines
+    are the same bytes as returned by `readline`, i.e., with their trailing line
+    breaks, and blank lines are kept.
+    :param stream: binary file-like object.
+    :param chunk_size: number of bytes read from `stream` at a time.
+    :return: generator of lines.
+    """
+    buffer = b''
+    while True:
+        data = stream.read(chunk_size)
+        if not data:
+            if buffer:
+                yield buffer
+            return
+        buffer += data
+        parts = buffer.split(b'\n')
+        buffer = parts.pop()
+        for part in parts:
+            yield part + b'\n'
+
 
-    if os.path.exists(path):
-        with open(path, 'r') as f:
-            custom_token: dict = json.load(f)
-        for (k, v) in custom_token.items():
-            token[k] = v
+@functools.lru_cache(maxsize=None)
+def get_mongodb_client(url: str) -> MongoClient:
+    """
+    Get the mongodb client connected to `url`. Clients are thread-safe and pool
+    their connections, so a single client is shared by all crawlers of the
+    process that connect to the same url.
+    :param url: mongodb connection string.
+    :return: mongodb client.
+    """
+    return MongoClient(url)
+
+
+@dataclass(slots=True)
+class HourTask:
+    """
+    Names and locations of the gh archive data generated during an hour, which
+    are computed once and shared by all steps of the crawling.
+    """
+    date: str
+    hour: int
+    gh_file_name: str
+    path: str
+    url: str
+    # whether the server has rejected the request with a client error (e.g., 404),
+    # in which case the data is not requested again.
+    is_rejected: bool = False
 
-    if (kwargs is not None) and (len(kwargs) > 0):
-        for (k, v) in kwargs.items():
-            token[k] = v
 
-    return token
+class TeeReader:
+    """
+    File-like object that reads from `src` and copies everything it reads into
+    `path`. Data is written to a temporary `.part` file that is renamed to `path`
+    only when `commit` is called, and removed if the reader is closed without
+    being committed. A connection closed early looks like the end of `src`, so
+    it is up to the caller to commit only after validating the data, e.g., when
+    the gzip decompressor reading from this object reaches the end of stream.
+    """
+    def __init__(self, src, path):
+        self.src = src
+        self.path = path
+        self.part_path = f'{path}.part'
+        self.f = open(self.part_path, 'wb')
+        self.committed = False
+    
+    def read(self, size=-1) -> bytes:
+        data = self.src.read(size)
+        if data:
+            self.f.write(data)
+        return data
+    
+    def commit(self):
+        self.f.close()
+        os.replace(self.part_path, self.path)
+        self.committed = True
+    
+    def close(self):
+        if not self.committed:
+            self.f.close()
+            if os.path.exists(self.part_path):
+                os.remove(self.part_path)
+        self.src.close()
 
 
 class Crawler:
-    def __init__(self, gh_archive_dir: str, mongodb_token: dict, gh_archive_token: dict):
+    def __init__(self, gh_archive_dir: str, mongodb_token: MongoToken, gh_archive_token: GhArchiveToken):
         self.gh_archive_dir = gh_archive_dir
         self.mongodb_token = mongodb_token
         self.gh_archive_token = gh_archive_token
         self.mongodb_client = self.__get_mongodb_client()
-        self.db = self.mongodb_client[self.mongodb_token['db']]
+        self.db = self.mongodb_client[self.mongodb_token.db]
+        self._fs = gridfs.GridFS(self.db)
+        self._status_col = self.db['status']
+        self._gridfs_meta_col = self.db['gridfs']
+        self._pending_gridfs_meta = []
+        # datetimes known to exist in the "status" collection, or None to query
+        # the collection for each hour.
+        self._present_datetimes = None
+        # keep-alive connections to the gh archive server shared by all downloads,
+        # or None to open a new connection per download with `urlopen`.
+        self._http = None
+        if urllib3 is not None:
+            self._http = urllib3.PoolManager(num_pools=1, maxsize=DOWNLOAD_CONCURRENCY, block=False,
+                                             retries=urllib3.Retry(3, backoff_factor=0.3))
     
     def __get_mongodb_client(self) -> MongoClient:
-        user = self.mongodb_token['user']
-        password = self.mongodb_token['password']
-        ip = self.mongodb_token['ip']
-        port = self.mongodb_token['port']
+        user = self.mongodb_token.user
+        password = self.mongodb_token.password
+        ip = self.mongodb_token.ip
+        port = self.mongodb_token.port
         url = f'mongodb://{user}:{password}@{ip}:{port}/?'
-        for (k, v) in self.mongodb_token['params'].items():
+        params = {**MONGODB_DEFAULT_PARAMS, **self.mongodb_token.params}
+        for (k, v) in params.items():
             url = url + f'{k}={v}&'
         url = url[:-1]
-        return MongoClient(url)
+        return get_mongodb_client(url)
     
-    def __get_gh_archive_request(self, date, hour) -> Request:
+    def __get_hour_task(self, date, hour) -> HourTask:
         gh_file_name = f'{date}-{hour}.json.gz'
-        url = self.gh_archive_token['url']
+        path = os.path.join(self.gh_archive_dir, date, gh_file_name)
+        url = self.gh_archive_token.url
         url = f'{url}{gh_file_name}'
-        headers = self.gh_archive_token['headers']
-        return Request(url, headers=headers)
+        return HourTask(date, hour, gh_file_name, path, url)
     
-    def __is_hourly_gh_data_exists_in_mongodb(self, date, hour) -> bool:
-        col = self.db['status']
-        doc = col.find_one({'datetime': f'{date}-{hour}'})
+    def __get_gh_archive_request(self, task: HourTask) -> Request:
+        headers = self.gh_archive_token.headers
+        return Request(task.url, headers=headers)
+    
+    def __find_present_datetimes(self, prefix) -> set:
+        docs = self._status_col.find({'datetime': {'$regex': f'^{re.escape(prefix)}'}}, {'datetime': 1, '_id': 0})
+        return {doc['datetime'] for doc in docs}
+    
+    def __is_hourly_gh_data_exists_in_mongodb(self, task: HourTask) -> bool:
+        datetime = f'{task.date}-{task.hour}'
+        if self._present_datetimes is not None:
+            return datetime in self._present_datetimes
+        doc = self._status_col.find_one({'datetime': datetime})
         return doc is not None
     
-    def __is_hourly_gh_data_exists_in_localfs(self, date, hour) -> bool:
-        gh_file_name = f'{date}-{hour}.json.gz'
-        path = os.path.join(self.gh_archive_dir, date, gh_file_name)
-        return os.path.exists(path)
+    def __is_hourly_gh_data_exists_in_localfs(self, task: HourTask) -> bool:
+        return os.path.exists(task.path)
     
-    def __download_hourly_gh_data_from_server(self, date, hour) -> bool:
-        request: Request = self.__get_gh_archive_request(date, hour)
+    def __open_gh_archive_response(self, task: HourTask):
+        if self._http is not None:
+            return self.__open_gh_archive_response_in_pool(task)
+        request: Request = self.__get_gh_archive_request(task)
+        try:
+            return urlopen(request)
+        except HTTPError as e:
+            task.is_rejected = 400 <= e.code < 500
+            sys.stderr.write(f'Failed to get response from {task.url}, and the error code is {e.code}.\n')
+        except URLError as e:
+            sys.stderr.write(f'Failed to request {task.url}, and the reason is {e.reason}.\n')
+        return None
+    
+    def __open_gh_archive_response_in_pool(self, task: HourTask):
+        headers = self.gh_archive_token.headers
+        try:
+            # the data is kept gzipped as it is, which is decompressed by the crawler.
+            response = self._http.request('GET', task.url, headers=headers, preload_content=False,
+                                          decode_content=False)
+        except urllib3.exceptions.HTTPError as e:
+            sys.stderr.write(f'Failed to request {task.url}, and the reason is {e}.\n')
+            return None
+        if response.status != 200:
+            task.is_rejected = 400 <= response.status < 500
+            # read the rest of the body so that the connection can be reused.
+            response.drain_conn()
+            response.release_conn()
+            sys.stderr.write(f'Failed to get response from {task.url}, and the error code is {response.status}.\n')
+            return None
+        return response
+    
+    def __download_hourly_gh_data_from_server(self, task: HourTask) -> bool:
+        response = self.__open_gh_archive_response(task)
+        if response is None:
+            return False
         success = False
-        gh_file_name = f'{date}-{hour}.json.gz'
-        path = os.path.join(self.gh_archive_dir, date, gh_file_name)
+        path = task.path
         try:
-            response = urlopen(request)
-            amt = 1024 * 1024
-            gh_file_dir = os.path.join(self.gh_archive_dir, date)
-            if not os.path.exists(gh_file_dir):
-                os.makedirs(gh_file_dir)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
             with open(path, 'wb') as f:
-                while True:
-                    buffer = response.read(amt)
-                    if not buffer:
-                        break
-                    f.write(buffer)
+                shutil.copyfileobj(response, f, length=DOWNLOAD_BUFFER_SIZE)
             success = True
-        except HTTPError as e:
-            gh_file_name = f'{date}-{hour}.json.gz'
-            url = self.gh_archive_token['url']
-            url = f'{url}{gh_file_name}'
-            sys.stderr.write(f'Failed to get response from {url}, and the error code is {e.code}.\n')
-        except URLError as e:
-            gh_file_name = f'{date}-{hour}.json.gz'
-            url = self.gh_archive_token['url']
-            url = f'{url}{gh_file_name}'
-            sys.stderr.write(f'Failed to request {url}, and the reason is {e.reason}.\n')
         finally:
+            response.close()
             if not success and os.path.exists(path):
                 os.remove(path)
         return success
     
-    def __get_hourly_gh_data_in_gzip_stream(self, date, hour):
-        gh_file_name = f'{date}-{hour}.json.gz'
-        path = os.path.join(self.gh_archive_dir, date, gh_file_name)
-        if self.__is_hourly_gh_data_exists_in_localfs(date, hour):
-            gzip_file = gzip.GzipFile(path)
-        else:
-            success = self.__download_hourly_gh_data_from_server(date, hour)
-            gzip_file = gzip.GzipFile(path) if success else None
-        return gzip_file
+    def __get_hourly_gh_data_in_gzip_stream(self, task: HourTask):
+        """
+        :return: the decompressed stream and the `TeeReader` it reads from, which is
+        None if the data is read from the local filesystem. Both of them have to be
+        closed by the caller, since `gzip.GzipFile` does not close a given `fileobj`.
+        """
+        if self.__is_hourly_gh_data_exists_in_localfs(task):
+            return io.BufferedReader(gzip.open(task.path, 'rb'), buffer_size=READ_BUFFER_SIZE), None
+        
+        # the error has been reported when prefetching the data.
+        if task.is_rejected:
+            return None, None
+        
+        # decompress the response while downloading it, and keep a copy of the
+        # compressed data in the local filesystem.
+        response = self.__open_gh_archive_response(task)
+        if response is None:
+            return None, None
+        os.makedirs(os.path.dirname(task.path), exist_ok=True)
+        tee_reader = TeeReader(response, task.path)
+        gzip_file = gzip.GzipFile(fileobj=tee_reader)
+        return io.BufferedReader(gzip_file, buffer_size=READ_BUFFER_SIZE), tee_reader
+    
+    def __prefetch_hourly_gh_data(self, task: HourTask) -> bool:
+        # prefetching is best-effort, since the hour is downloaded again when it
+        # is inserted into mongodb if the prefetching fails.
+        try:
+            if self.__is_hourly_gh_data_exists_in_mongodb(task):
+                return True
+            if self.__is_hourly_gh_data_exists_in_localfs(task):
+                return True
+            return self.__download_hourly_gh_data_from_server(task)
+        except Exception as e:
+            sys.stderr.write(f'Failed to prefetch {task.url}.\n{traceback.format_exc()}\n')
+            return False
     
-    def __insert_event_by_gridfs(self, date, hour, line):
-        fs = gridfs.GridFS(self.db)
-        file_id = fs.put(line)
+    def __insert_event_by_gridfs(self, task: HourTask, line):
+        file_id = self._fs.put(line)
         
-        col = self.db['gridfs']
-        result = col.insert_one({'file_id': file_id, 'date': date, 'hour': hour})
-        assert result.acknowledged
+        # metadata is inserted in batch once all events of the hour are inserted.
+        self._pending_gridfs_meta.append({'file_id': file_id, 'date': task.date, 'hour': task.hour})
         return file_id
     
     def __delete_event_by_gridfs(self, file_id):
-        fs = gridfs.GridFS(self.db)
-        fs.delete(file_id)
+        self._fs.delete(file_id)
     
-    def __insert_hourly_gh_data_into_mongodb(self, date, hour) -> bool:
-        if self.__is_hourly_gh_data_exists_in_mongodb(date, hour):
+    def __insert_events_one_by_one(self, col, task: HourTask, events, lines, inserted_file_ids) -> bool:
+        for (event, line) in zip(events, lines):
+            try:
+                col.insert_one(event)
+            except DuplicateKeyError as e:
+                # the event has already been inserted by the failed `insert_many` call.
+                pass
+            except DocumentTooLarge as e:
+                file_id = self.__insert_event_by_gridfs(task, line)
+                inserted_file_ids.append(file_id)
+            except WriteError as e:
+                if e.code not in GRIDFS_FALLBACK_ERROR_CODES:
+                    raise
+                file_id = self.__insert_event_by_gridfs(task, line)
+                inserted_file_ids.append(file_id)
+        return True
+    
+    def __insert_events_in_batch(self, col, task: HourTask, events, event_ids, lines, inserted_ids,
+                                 inserted_file_ids) -> bool:
+        """
+        Insert `events` into `col` with a single unordered `insert_many` call, and
+        re-route the events rejected by mongodb into gridfs. `event_ids` are the ids
+        assigned to `events` in advance, which are appended to `inserted_ids` before
+        the insertion, since the server may have written part of the events when
+        the call fails (e.g., on a network error). Ids of the files are appended to
+        `inserted_file_ids`. Both of them are used to roll back the insertion.
+        :return: whether all events are inserted.
+        """
+        # deleting ids of events that are never inserted does nothing in the rollback.
+        inserted_ids.extend(event_ids)
+        try:
+            result = col.insert_many(events, ordered=False)
+            if not result.acknowledged:
+                return False
+        except BulkWriteError as e:
+            write_errors = {error['index']: error['code'] for error in e.details.get('writeErrors', [])}
+            is_recoverable = all(code in GRIDFS_FALLBACK_ERROR_CODES for code in write_errors.values())
+            if is_recoverable:
+                for index in sorted(write_errors):
+                    file_id = self.__insert_event_by_gridfs(task, lines[index])
+                    inserted_file_ids.append(file_id)
+            if not is_recoverable:
+                sys.stderr.write(f'{traceback.format_exc()}\n')
+                return False
+        except DocumentTooLarge as e:
+            # the oversized event is rejected before being sent, so retry the
+            # batch event by event to locate it.
+            return self.__insert_events_one_by_one(col, task, events, lines, inserted_file_ids)
+        return True
+    
+    def __insert_hourly_gh_data_into_mongodb(self, task: HourTask) -> bool:
+        date, hour = task.date, task.hour
+        if self.__is_hourly_gh_data_exists_in_mongodb(task):
             sys.stderr.write(f'events generated during {date}-{hour} already exist in the local mongodb.\n')
             return True
         
-        gzip_file = self.__get_hourly_gh_data_in_gzip_stream(date, hour)
+        gzip_file, tee_reader = self.__get_hourly_gh_data_in_gzip_stream(task)
         if gzip_file is None:
             return False
         
         col = self.db[date]
+        self._pending_gridfs_meta = []
         is_insertion_complete = True
+        is_stream_complete = False
         inserted_ids = []
         inserted_file_ids = []
+        inserted_meta_ids = []
+        events = []
+        event_ids = []
+        lines = []
+        gh_lines = iter_lines(gzip_file)
+        # bind to locals to skip attribute lookups for every event.
+        loads = _json.loads
+        new_id = ObjectId
+        append_event = events.append
+        append_event_id = event_ids.append
+        append_line = lines.append
         while True:
             try:
-                line = gzip_file.readline()
+                line = next(gh_lines, b'')
+                if line:
+                    try:
+                        event = loads(line)
+                        # encode the event into bson only once, and set its id in
+                        # advance since pymongo can not add ids to raw documents.
+                        event_id = event['_id'] = new_id()
+                        event = RawBSONDocument(encode(event))
+                    except (JSONDecodeError, InvalidDocument, OverflowError) as e:
+                        file_id = self.__insert_event_by_gridfs(task, line)
+                        inserted_file_ids.append(file_id)
+                        continue
+                    append_event(event)
+                    append_event_id(event_id)
+                    append_line(line)
+                if len(events) >= INSERT_BATCH_SIZE or (not line and len(events) > 0):
+                    if not self.__insert_events_in_batch(col, task, events, event_ids, lines, inserted_ids,
+                                                        inserted_file_ids):
+                        sys.stderr.write(f'Failed to insert events into the "{date}" collection of the {self.mongodb_token.db}.\n')
+                        is_insertion_complete = False
+                        break
+                    events.clear()
+                    event_ids.clear()
+                    lines.clear()
                 if not line:
+                    # the decompressor raises `EOFError` on truncated data, so the
+                    # whole gzip stream is valid once it is read to the end.
+                    is_stream_complete = True
                     break
-                event = json.loads(line)
-                result = col.insert_one(event)
-                if not result.acknowledged:
-                    sys.stderr.write(f'Failed to insert the event into the "{date}" collection of the {self.mongodb_token["db"]}.\n')
-                    is_insertion_complete = False
-                    break
-                inserted_ids.append(result.inserted_id)
             except EOFError as e:
-                gh_file_name = f'{date}-{hour}.json.gz'
-                path = os.path.join(self.gh_archive_dir, date, gh_file_name)
+                path = task.path
                 if os.path.exists(path):
                     os.remove(path)
                 sys.stderr.write(f'Compressed file ({path}) ended before the end-of-stream marker was reached.\n')
                 is_insertion_complete = False
                 break
-            except JSONDecodeError as e:
-                file_id = self.__insert_event_by_gridfs(date, hour, line)
-                inserted_file_ids.append(file_id)
-            except DocumentTooLarge as e:
-                file_id = self.__insert_event_by_gridfs(date, hour, line)
-                inserted_file_ids.append(file_id)
-            except WriteError as e:
-                file_id = self.__insert_event_by_gridfs(date, hour, line)
-                inserted_file_ids.append(file_id)
             except Exception as e:
                 sys.stderr.write(f'{traceback.format_exc()}\n')
                 is_insertion_complete = False
                 break
+        gzip_file.close()
+        if tee_reader is not None:
+            if is_stream_complete:
+                tee_reader.commit()
+            tee_reader.close()
+        
+        if is_insertion_complete and len(self._pending_gridfs_meta) > 0:
+            try:
+                self._gridfs_meta_col.insert_many(self._pending_gridfs_meta, ordered=False)
+            except Exception as e:
+                sys.stderr.write(f'{traceback.format_exc()}\n')
+                is_insertion_complete = False
+            # pymongo sets the ids of documents before sending them, so that ids of
+            # partially inserted documents are also recorded for the rollback.
+            inserted_meta_ids.extend(meta['_id'] for meta in self._pending_gridfs_meta if '_id' in meta)
+        self._pending_gridfs_meta = []
         
         if is_insertion_complete:
-            col = self.db['status']
-            result = col.insert_one({'datetime': f'{date}-{hour}'})
-            if not result.acknowledged:
-                sys.stderr.write(f'Failed to insert the {date}-{hour} document into the "status" collection of the {self.mongodb_token["db"]}.\n')
+            try:
+                result = self._status_col.insert_one({'datetime': f'{date}-{hour}'})
+                if not result.acknowledged:
+                    sys.stderr.write(f'Failed to insert the {date}-{hour} document into the "status" collection of the {self.mongodb_token.db}.\n')
+                    is_insertion_complete = False
+            except DuplicateKeyError as e:
+                sys.stderr.write(f'events generated during {date}-{hour} have been inserted by another crawler.\n')
                 is_insertion_complete = False
         
         if not is_insertion_complete:
-            if len(inserted_ids) > 0:
-                for inserted_id in inserted_ids:
-                    result = col.delete_one({"_id": inserted_id})
-                    assert result.acknowledged
+            for i in range(0, len(inserted_ids), INSERT_BATCH_SIZE):
+                result = col.delete_many({'_id': {'$in': inserted_ids[i:i + INSERT_BATCH_SIZE]}})
+                assert result.acknowledged
             if len(inserted_file_ids) > 0:
                 for file_id in inserted_file_ids:
                     self.__delete_event_by_gridfs(file_id)
+            if len(inserted_meta_ids) > 0:
+                result = self._gridfs_meta_col.delete_many({'_id': {'$in': inserted_meta_ids}})
+                assert result.acknowledged
             return False
         return True
     
-    def insert_hourly_gh_data_into_mongodb(self, date, hour):
-        if self.__insert_hourly_gh_data_into_mongodb(date, hour):
-            print(f'pass,{date},{hour}')
+    def ensure_status_index(self) -> bool:
+        """
+        Create the unique index on the datetime of the "status" collection, which
+        speeds up the lookup of inserted hours and prevents concurrent crawlers from
+        inserting the same hour twice. It only needs to be called once, before the
+        crawling starts.
+        :return: whether the index exists.
+        """
+        try:
+            self._status_col.create_index('datetime', unique=True)
+            return True
+        except OperationFailure as e:
+            sys.stderr.write(f'Failed to create the unique index on the datetime of the "status" collection '
+                             f'of the {self.mongodb_token.db}, and the reason is {e}. Please remove duplicate '
+                             f'datetimes from the collection, otherwise concurrent crawlers may insert the '
+                             f'same hour twice.\n')
+            return False
+    
+    def __insert_and_report_hourly_gh_data(self, task: HourTask):
+        if self.__insert_hourly_gh_data_into_mongodb(task):
+            print(f'pass,{task.date},{task.hour}')
         else:
-            print(f'fail,{date},{hour}')
+            print(f'fail,{task.date},{task.hour}')
+    
+    def insert_hourly_gh_data_into_mongodb(self, date, hour):
+        self.__insert_and_report_hourly_gh_data(self.__get_hour_task(date, hour))
     
     def insert_daily_gh_data_into_mongodb(self, date):
-        for hour in range(24):
-            self.insert_hourly_gh_data_into_mongodb(date, hour)
+        tasks = [self.__get_hour_task(date, hour) for hour in range(24)]
+        # look up the inserted hours of the day with a single query.
+        self._present_datetimes = self.__find_present_datetimes(f'{date}-')
+        try:
+            # download hours concurrently, while inserting them into mongodb in
+            # order as soon as each of them is ready.
+            with ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY) as executor:
+                futures = [executor.submit(self.__prefetch_hourly_gh_data, task) for task in tasks]
+                for (task, future) in zip(tasks, futures):
+                    future.result()
+                    self.__insert_and_report_hourly_gh_data(task)
+        finally:
+            self._present_datetimes = None
+    
+    def __insert_daily_gh_data_in_parallel(self, dates):
+        # each day is ingested by a crawler in its own worker process.
+        max_workers = min(os.cpu_count() or 1, MAX_WORKER_PROCESSES)
+        with ProcessPoolExecutor(max_workers=max_workers, max_tasks_per_child=DAYS_PER_WORKER) as executor:
+            futures = [executor.submit(_insert_daily_gh_data_into_mongodb, self.gh_archive_dir,
+                                       self.mongodb_token, self.gh_archive_token, date) for date in dates]
+            for (date, future) in zip(dates, futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    sys.stderr.write(f'Failed to insert events generated on {date}.\n{traceback.format_exc()}\n')
     
     def insert_monthly_gh_data_into_mongodb(self, year, month):
         _, days = calendar.monthrange(year, month)
-        for day in range(1, days + 1, 1):
-            date = f'{year}-{month:02d}-{day:02d}'
-            self.insert_daily_gh_data_into_mongodb(date)
+        dates = [f'{year}-{month:02d}-{day:02d}' for day in range(1, days + 1, 1)]
+        self.__insert_daily_gh_data_in_parallel(dates)
 
     def insert_yearly_gh_data_into_mongodb(self, year):
+        dates = []
         for month in range(1, 13, 1):
-            self.insert_monthly_gh_data_into_mongodb(year, month)
+            _, days = calendar.monthrange(year, month)
+            dates.extend(f'{year}-{month:02d}-{day:02d}' for day in range(1, days + 1, 1))
+        self.__insert_daily_gh_data_in_parallel(dates)
+
+
+def _insert_daily_gh_data_into_mongodb(gh_archive_dir, mongodb_token, gh_archive_token, date):
+    # entry of worker processes, which has to be defined at module level to be pickled.
+    c = Crawler(gh_archive_dir, mongodb_token, gh_archive_token)
+    c.insert_daily_gh_data_into_mongodb(date)
 
 
 def show_command_tip():
@@ -257,31 +640,35 @@ def main():
         if '-y' == argv[7]:
             assert len(argv) == 9
             year = int(argv[8])
-            mongodb_token = load_token(mongodb_token_path, user=user, password=password)
-            gh_archive_token = load_token(gh_archive_token_path)
+            mongodb_token = load_mongodb_token(mongodb_token_path, user=user, password=password)
+            gh_archive_token = load_gh_archive_token(gh_archive_token_path)
             c = Crawler(gh_archive_dir, mongodb_token, gh_archive_token)
+            c.ensure_status_index()
             c.insert_yearly_gh_data_into_mongodb(year)
         elif '-m' == argv[7]:
             assert len(argv) == 10
             year, month = int(argv[8]), int(argv[9])
             assert 1 <= month <= 12
-            mongodb_token = load_token(mongodb_token_path, user=user, password=password)
-            gh_archive_token = load_token(gh_archive_token_path)
+            mongodb_token = load_mongodb_token(mongodb_token_path, user=user, password=password)
+            gh_archive_token = load_gh_archive_token(gh_archive_token_path)
             c = Crawler(gh_archive_dir, mongodb_token, gh_archive_token)
+            c.ensure_status_index()
             c.insert_monthly_gh_data_into_mongodb(year, month)
         elif '-d' == argv[7]:
             assert len(argv) == 9
             date = str(argv[8])
-            mongodb_token = load_token(mongodb_token_path, user=user, password=password)
-            gh_archive_token = load_token(gh_archive_token_path)
+            mongodb_token = load_mongodb_token(mongodb_token_path, user=user, password=password)
+            gh_archive_token = load_gh_archive_token(gh_archive_token_path)
             c = Crawler(gh_archive_dir, mongodb_token, gh_archive_token)
+            c.ensure_status_index()
             c.insert_daily_gh_data_into_mongodb(date)
         elif '-h' == argv[7]:
             assert len(argv) == 10
             date, hour = str(argv[8]), int(argv[9])
-            mongodb_token = load_token(mongodb_token_path, user=user, password=password)
-            gh_archive_token = load_token(gh_archive_token_path)
+            mongodb_token = load_mongodb_token(mongodb_token_path, user=user, password=password)
+            gh_archive_token = load_gh_archive_token(gh_archive_token_path)
             c = Crawler(gh_archive_dir, mongodb_token, gh_archive_token)
+            c.ensure_status_index()
             c.insert_hourly_gh_data_into_mongodb(date, hour)
         else:
             show_command_tip()
@@ -290,5 +677,6 @@ def main():
 
 
 if __name__ == '__main__':
+    freeze_support()
     main()
 